@@ -1,9 +1,9 @@
-from collections import defaultdict, namedtuple
-from numbers import Number
+from collections import namedtuple
+from numbers import Integral, Number
 
 import numpy
 
-from numpy import array, diag, dot, eye, float64, int32, log, sqrt, zeros
+from numpy import array, diag, dot, float64, int32, log, sqrt, zeros
 from numpy.linalg import det, inv
 
 from cogent3.core.moltype import DNA, RNA, get_moltype
@@ -11,7 +11,20 @@ from cogent3.util.dict_array import DictArray
 from cogent3.util.misc import get_object_provenance
 from cogent3.util.progress_display import display_wrap
 
-from .pairwise_distance_numba import fill_diversity_matrix
+from .pairwise_distance_numba import (
+    PUR_TS,
+    PYR_TS,
+    TV,
+    fill_diversity_matrices,
+    fill_diversity_matrices_serial,
+    get_duplicates,
+    hamming,
+    jc69_from_matrix,
+    logdet,
+    paralinear,
+)
+from .pairwise_distance_numba import seq_to_indices as _seq_to_indices
+from .pairwise_distance_numba import tn93_from_matrix
 
 
 __author__ = "Gavin Huttley, Yicheng Zhu and Ben Kaehler"
@@ -24,6 +37,19 @@ __email__ = "gavin.huttley@anu.edu.au"
 __status__ = "Alpha"  # pending addition of protein distance metrics
 
 
+# upper bound on the number of diversity matrix elements held in memory
+# while computing pairwise distances as matrix products
+_MAX_MATRIX_ELEMENTS = 2 ** 24
+
+# upper bound on the number of elements of the buffer of diversity matrices
+# filled by a single call to the numba kernels, larger buffers did not reduce
+# the call overhead further
+_MAX_BUFFER_ELEMENTS = 2 ** 16
+
+# the float32 counts from a matrix product are exact up to this length
+_MAX_EXACT_FLOAT32 = 2 ** 24
+
+
 def _same_moltype(ref, query):
     """if ref and query have the same states"""
     return set(ref) == set(query)
@@ -55,12 +81,34 @@ def get_matrix_diff_coords(indices):
 
 
 def get_moltype_index_array(moltype, invalid=-9):
-    """returns the index array for a molecular type"""
+    """returns the index array for a molecular type
+
+    Parameters
+    ----------
+    moltype
+        MolType instance
+    invalid
+        the index for characters that are not canonical states, must be a
+        negative integer
+
+    Notes
+    -----
+    The array has the smallest signed integer dtype that can hold both the
+    indices and invalid, int8 for the default invalid except for the bytes
+    moltype. It has at least 256 entries so every byte value can be looked up.
+    """
+    if not isinstance(invalid, Integral) or invalid >= 0:
+        raise ValueError(f"invalid must be a negative integer, not {invalid!r}")
+
     canonical_chars = list(moltype)
     # maximum ordinal for an allowed character, this defines the length of
     # the required numpy array
     max_ord = max(list(map(ord, list(moltype.All.keys()))))
-    char_to_index = zeros(max_ord + 1, int32)
+    # the indices range up to len(canonical_chars) - 1
+    dtype = numpy.result_type(
+        numpy.min_scalar_type(-len(canonical_chars)), numpy.min_scalar_type(invalid)
+    )
+    char_to_index = zeros(max(max_ord + 1, 256), dtype)
     # all non canonical_chars are ``invalid''
     char_to_index.fill(invalid)
 
@@ -73,9 +121,25 @@ def get_moltype_index_array(moltype, invalid=-9):
 
 
 def seq_to_indices(seq, char_to_index):
-    """returns an array with sequence characters replaced by their index"""
-    ords = list(map(ord, seq))
-    return char_to_index.take(ords)
+    """returns an array with sequence characters replaced by their index
+
+    Parameters
+    ----------
+    seq
+        str or bytes
+    char_to_index
+        the result of get_moltype_index_array
+    """
+    if isinstance(seq, str):
+        # latin-1 maps each character to a byte equal to its ordinal
+        seq = seq.encode("latin-1")
+    ords = numpy.frombuffer(seq, dtype=numpy.uint8)
+    if len(char_to_index) < 256:
+        # the compiled lookup does not check bounds
+        return char_to_index.take(ords)
+    indices = numpy.empty(len(ords), dtype=char_to_index.dtype)
+    _seq_to_indices(ords, char_to_index, indices)
+    return indices
 
 
 def _fill_diversity_matrix(matrix, seq1, seq2):
@@ -84,10 +148,87 @@ def _fill_diversity_matrix(matrix, seq1, seq2):
     Assumes the provided sequences have been converted to indices with
     invalid characters being negative numbers (use get_moltype_index_array
     plus seq_to_indices)."""
-    paired = array([seq1, seq2]).T
-    paired = paired[paired.min(axis=1) >= 0]
-    for i in range(len(paired)):
-        matrix[paired[i][0], paired[i][1]] += 1
+    valid = (seq1 >= 0) & (seq2 >= 0)
+    # encode each pair of states as the index into the flattened matrix
+    codes = seq1[valid].astype(numpy.intp) * matrix.shape[1] + seq2[valid]
+    counts = numpy.bincount(codes, minlength=matrix.size)
+    matrix += counts.reshape(matrix.shape)
+
+
+def _one_hot(indexed_seqs, dim, xp=numpy):
+    """returns the one-hot encoding of indexed sequences
+
+    Parameters
+    ----------
+    indexed_seqs
+        2D array of sequences converted to indices, invalid characters are
+        negative numbers
+    dim
+        number of canonical states
+    xp
+        the array module of indexed_seqs, numpy or cupy
+
+    Returns
+    -------
+    float32 array with shape (num_seqs, dim, seq_len), invalid characters
+    are 0 for all states
+    """
+    states = xp.arange(dim)[None, :, None]
+    return (indexed_seqs[:, None, :] == states).astype(xp.float32)
+
+
+def _all_diversity_matrices(seqs_1, seqs_2, dim, xp=numpy):
+    """returns the diversity matrices for all pairs of sequences from
+    seqs_1 and seqs_2
+
+    Parameters
+    ----------
+    seqs_1, seqs_2
+        2D arrays of sequences converted to indices, invalid characters are
+        negative numbers
+    dim
+        number of canonical states
+    xp
+        the array module of the sequences, numpy or cupy
+
+    Returns
+    -------
+    array with shape (len(seqs_1), len(seqs_2), dim, dim) where element
+    [i, j] is the diversity matrix of seqs_1[i] and seqs_2[j]
+
+    Notes
+    -----
+    All matrices are computed as a single matrix product of the one-hot
+    encoded sequences. The float32 counts are exact for sequences shorter
+    than 2 ** 24. On a CPU, filling each matrix with the numba kernel is
+    quicker unless invalid characters are frequent and scattered, so this is
+    only used for computing on a GPU.
+    """
+    num_1, seq_len = seqs_1.shape
+    num_2 = seqs_2.shape[0]
+    one_hot_1 = _one_hot(seqs_1, dim, xp=xp).reshape(num_1 * dim, seq_len)
+    one_hot_2 = _one_hot(seqs_2, dim, xp=xp).reshape(num_2 * dim, seq_len)
+    counts = one_hot_1 @ one_hot_2.T
+    counts = counts.reshape(num_1, dim, num_2, dim).transpose(0, 2, 1, 3)
+    return counts.astype(xp.float64)
+
+
+def _get_cupy():
+    """returns the cupy module if it is installed and there is a GPU"""
+    try:
+        import cupy
+    except ImportError:
+        raise ImportError("cupy not installed")
+
+    if not cupy.cuda.is_available():
+        raise RuntimeError("no CUDA device available for cupy")
+
+    return cupy
+
+
+# The following python distance functions are reference implementations of
+# the numba kernels in pairwise_distance_numba, which the calculators use.
+# They are only called by the tests.
 
 
 def _hamming(matrix):
@@ -211,7 +352,9 @@ def _logdetcommon(matrix):
     # we replace the missing diagonal states with a frequency of 0.5,
     # then normalise
     frequency = matrix.copy()
-    frequency[(frequency == 0) * eye(*matrix.shape, dtype=bool)] = 0.5
+    diagonal = frequency.diagonal().copy()
+    diagonal[diagonal == 0] = 0.5
+    numpy.fill_diagonal(frequency, diagonal)
     frequency /= frequency.sum()
 
     if det(frequency) <= 0:  # if the result is nan
@@ -289,17 +432,15 @@ def _make_stat_table(stats, names, **kwargs):
     from cogent3.util.table import Table
 
     header = [r"Seq1 \ Seq2"] + names
-    rows = zeros((len(names), len(names)), dtype="O")
-    for i in range(len(names) - 1):
-        n1 = names[i]
-        for j in range(i + 1, len(names)):
-            n2 = names[j]
-            val = stats[(n1, n2)]
-            rows[i, j] = val
-            rows[j, i] = val
-    rows = rows.tolist()
-    for i in range(len(names)):
-        rows[i].insert(0, names[i])
+    # stats only has the (names[i], names[j]), i < j, keys
+    rows = [
+        [n1]
+        + [
+            0 if i == j else stats[(n1, n2) if i < j else (n2, n1)]
+            for j, n2 in enumerate(names)
+        ]
+        for i, n1 in enumerate(names)
+    ]
 
     return Table(
         header=header, data=rows, index_name=r"Seq1 \ Seq2", missing_data="*", **kwargs
@@ -310,8 +451,18 @@ class _PairwiseDistance(object):
     """base class for computing pairwise distances"""
 
     valid_moltypes = ()
-
-    def __init__(self, moltype, invalid=-9, alignment=None, invalid_raises=False):
+    # whether self.func estimates the variance of the distance
+    _estimates_variance = True
+
+    def __init__(
+        self,
+        moltype,
+        invalid=-9,
+        alignment=None,
+        invalid_raises=False,
+        parallel=False,
+        gpu=False,
+    ):
         super(_PairwiseDistance, self).__init__()
         moltype = get_moltype(moltype)
         if moltype.label not in self.valid_moltypes:
@@ -329,8 +480,14 @@ class _PairwiseDistance(object):
         self._dupes = None
         self._duped = None
         self._invalid_raises = invalid_raises
+        # numba's thread pool is not safe to use from multiple Python threads
+        # and oversubscribes cores within process pools, so it is opt-in
+        self._parallel = parallel
+        # computing the matrices on a GPU requires cupy
+        self._gpu = gpu
 
         self.names = None
+        self._order = None
         self.indexed_seqs = None
 
         if alignment is not None:
@@ -345,13 +502,16 @@ class _PairwiseDistance(object):
 
         self._dists = {}
         self.names = alignment.names[:]
+        self._order = {n: i for i, n in enumerate(self.names)}
         indexed_seqs = []
         for name in self.names:
             seq = alignment.get_gapped_seq(name)
             indexed = seq_to_indices(str(seq), self.char_to_indices)
             indexed_seqs.append(indexed)
 
-        self.indexed_seqs = array(indexed_seqs)
+        self.indexed_seqs = numpy.ascontiguousarray(
+            indexed_seqs, dtype=self.char_to_indices.dtype
+        )
 
     @property
     def duplicated(self):
@@ -363,71 +523,140 @@ class _PairwiseDistance(object):
     def func():
         pass  # over ride in subclasses
 
+    def _iter_diversity_matrices(self, pairs):
+        """yields sequence indices and diversity matrix for each pair
+
+        Parameters
+        ----------
+        pairs
+            2D array of row indices into self.indexed_seqs
+        """
+        # the diversity matrices are filled for a chunk of pairs, the chunk
+        # size bounding the memory used by the matrices. The kernel zeroes
+        # each matrix, so the same buffer is reused for every chunk.
+        fill = (
+            fill_diversity_matrices
+            if self._parallel
+            else fill_diversity_matrices_serial
+        )
+        chunk_size = max(1, _MAX_BUFFER_ELEMENTS // self._dim ** 2)
+        buffer = numpy.empty(
+            (min(chunk_size, len(pairs)), self._dim, self._dim), float64
+        )
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start : start + chunk_size]
+            matrices = buffer[: len(chunk)]
+            fill(matrices, self.indexed_seqs, chunk)
+            for (i, j), matrix in zip(chunk.tolist(), matrices):
+                yield i, j, matrix
+
+    def _iter_diversity_matrices_product(
+        self, pairs, xp, max_elements=_MAX_MATRIX_ELEMENTS
+    ):
+        """yields sequence indices and diversity matrix for each pair, the
+        matrices are computed as matrix products by _all_diversity_matrices
+
+        Parameters
+        ----------
+        pairs
+            2D array of row indices into self.indexed_seqs, ordered by the
+            first index of each pair
+        xp
+            the array module used for the computation, numpy or cupy
+        max_elements
+            bound on the number of elements of the one-hot encoded sequences
+            and of the diversity matrices computed together
+        """
+        if len(pairs) == 0:
+            # fewer than two unique sequences
+            return
+
+        to_host = getattr(xp, "asnumpy", numpy.asarray)
+        dim = self._dim
+        rows = numpy.unique(pairs)
+        num_rows = len(rows)
+        # position of each pair member in rows
+        index = numpy.searchsorted(rows, pairs)
+        seqs = xp.asarray(self.indexed_seqs[rows])
+        seq_len = seqs.shape[1]
+        # the matrices between a block of sequences and all sequences are
+        # computed together, summing the products over chunks of positions so
+        # both the one-hot encoding and the result are bounded in size. Each
+        # chunk is exactly counted in float32, the sum is in float64.
+        block_size = max(1, max_elements // (num_rows * dim ** 2))
+        chunk_len = max(1, min(_MAX_EXACT_FLOAT32, max_elements // (num_rows * dim)))
+        bounds = numpy.searchsorted(
+            index[:, 0], numpy.arange(0, num_rows + block_size, block_size)
+        )
+        for block, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if lo == hi:
+                continue
+            start = block * block_size
+            stop = min(start + block_size, num_rows)
+            counts = xp.zeros((stop - start, num_rows, dim, dim), xp.float64)
+            for pos in range(0, seq_len, chunk_len):
+                chunk = seqs[:, pos : pos + chunk_len]
+                counts += _all_diversity_matrices(chunk[start:stop], chunk, dim, xp=xp)
+            counts = to_host(counts)
+            for (i, j), (a, b) in zip(pairs[lo:hi].tolist(), index[lo:hi].tolist()):
+                yield i, j, numpy.ascontiguousarray(counts[a - start, b])
+
     @display_wrap
     def run(self, alignment=None, ui=None):
         """computes the pairwise distances"""
         self._dupes = None
         self._duped = None
 
-        dupes = set()
-        duped = defaultdict(list)
-
         if alignment is not None:
             self._convert_seqs_to_indices(alignment)
 
         names = self.names[:]
-        matrix = zeros((self._dim, self._dim), float64)
-        off_diag = [
-            (i, j) for i in range(self._dim) for j in range(self._dim) if i != j
-        ]
-        off_diag = tuple([tuple(a) for a in zip(*off_diag)])
+        # identifying duplicates first means their matrices are never filled.
+        # get_duplicates stops comparing a pair at the first difference, which
+        # is far quicker than counting all mismatches from the one-hot encoded
+        # seqs with a matrix product
+        parent = get_duplicates(self.indexed_seqs)
+        is_dupe = parent >= 0
+        unique = numpy.flatnonzero(~is_dupe)
+        # the pairs are in row order, tiling them into blocks of sequences
+        # did not improve timings as filling the matrices is compute bound
+        pairs = unique[numpy.array(numpy.triu_indices(len(unique), k=1)).T]
+
+        if self._gpu:
+            diversity_matrices = self._iter_diversity_matrices_product(
+                pairs, _get_cupy()
+            )
+        else:
+            diversity_matrices = self._iter_diversity_matrices(pairs)
 
         done = 0.0
-        to_do = (len(names) * len(names) - 1) / 2
-        for i in range(len(names) - 1):
-            if i in dupes:
-                continue
-
+        to_do = len(pairs)
+        for i, j, matrix in diversity_matrices:
             name_1 = names[i]
-            s1 = self.indexed_seqs[i]
-            for j in range(i + 1, len(names)):
-                if j in dupes:
-                    continue
-
-                name_2 = names[j]
-                ui.display(f"{name_1} vs {name_2}", done / to_do)
-                done += 1
-                matrix.fill(0)
-                s2 = self.indexed_seqs[j]
-                fill_diversity_matrix(matrix, s1, s2)
-                if not (matrix[off_diag] > 0).any():
-                    # j is a duplicate of i
-                    dupes.update([j])
-                    duped[i].append(j)
-                    continue
-
-                total, p, dist, var = self.func(matrix, *self._func_args)
-                if self._invalid_raises and not isinstance(dist, Number):
-                    msg = f"distance could not be calculated for {name_1} - {name_2}"
-                    raise ArithmeticError(msg)
-                result = Stats(total, p, dist, var)
-                self._dists[(name_1, name_2)] = result
-                self._dists[(name_2, name_1)] = result
-
-        self._dupes = [names[i] for i in dupes] or None
-        if duped:
-            self._duped = {}
-            for k, v in duped.items():
-                key = names[k]
-                vals = [names[i] for i in v]
-                self._duped[key] = vals
-
-            # clean the distances so only unique seqs included
-            remove = set(self._dupes)
-            keys = list(self._dists.keys())
-            for key in keys:
-                if set(key) & remove:
-                    del self._dists[key]
+            name_2 = names[j]
+            ui.display(f"{name_1} vs {name_2}", done / to_do)
+            done += 1
+
+            valid, total, p, dist, var = self.func(matrix, *self._func_args)
+            if not valid:
+                total = p = dist = var = None
+            elif not self._estimates_variance:
+                var = None
+
+            if self._invalid_raises and not isinstance(dist, Number):
+                msg = f"distance could not be calculated for {name_1} - {name_2}"
+                raise ArithmeticError(msg)
+            # name_1 precedes name_2 in names, so this is the canonical key
+            self._dists[(name_1, name_2)] = Stats(total, p, dist, var)
+
+        dupes = numpy.flatnonzero(is_dupe)
+        self._dupes = [names[j] for j in dupes.tolist()] or None
+        if self._dupes:
+            # group duplicates by the sequence they duplicate
+            parents, groups = numpy.unique(parent[dupes], return_inverse=True)
+            self._duped = {names[i]: [] for i in parents.tolist()}
+            for g, j in zip(groups.tolist(), dupes.tolist()):
+                self._duped[names[parents[g]]].append(names[j])
 
     __call__ = run
 
@@ -455,23 +684,27 @@ class _PairwiseDistance(object):
             # no duplicates, nothing to do
             return pwise
 
-        redundants = {}
-        for k in self.duplicated:
-            for r in self.duplicated[k]:
-                redundants[r] = k
-
-        names = self.names[:]
-        for add, alias in redundants.items():
-            for name in names:
-                if name == add:
-                    continue
-                if name == alias:
-                    val = 0
-                else:
-                    val = pwise.get((alias, name), None)
-                pwise[(add, name)] = pwise[(name, add)] = val
-
-        return pwise
+        num_seqs = len(self.names)
+        # index of the sequence that represents each sequence
+        rep = numpy.arange(num_seqs)
+        for k, dupes in self.duplicated.items():
+            rep[[self._order[n] for n in dupes]] = self._order[k]
+
+        stats = numpy.full((num_seqs, num_seqs), None, dtype="O")
+        for (name_1, name_2), val in pwise.items():
+            i, j = self._order[name_1], self._order[name_2]
+            stats[i, j] = stats[j, i] = val
+
+        # rows and columns of duplicates are copies of those they duplicate,
+        # and sequences sharing a representative are identical
+        stats = stats[numpy.ix_(rep, rep)]
+        stats[rep[:, None] == rep[None, :]] = 0
+        rows, cols = numpy.triu_indices(num_seqs, k=1)
+        names = self.names
+        return {
+            (names[i], names[j]): val
+            for i, j, val in zip(rows.tolist(), cols.tolist(), stats[rows, cols])
+        }
 
     @property
     def dists(self):
@@ -529,22 +762,26 @@ class HammingPair(_PairwiseDistance):
     """Hamming distance calculator for pairwise alignments"""
 
     valid_moltypes = ("dna", "rna", "protein", "text", "bytes")
+    # the variance calculation is not yet implemented
+    _estimates_variance = False
 
     def __init__(self, moltype="text", *args, **kwargs):
         """states: the valid sequence states"""
         super(HammingPair, self).__init__(moltype, *args, **kwargs)
-        self.func = _hamming
+        self.func = hamming
 
 
 class PercentIdentityPair(_PairwiseDistance):
     """Percent identity distance calculator for pairwise alignments"""
 
     valid_moltypes = ("dna", "rna", "protein", "text", "bytes")
+    # the variance calculation is not yet implemented
+    _estimates_variance = False
 
     def __init__(self, moltype="text", *args, **kwargs):
         """states: the valid sequence states"""
         super(PercentIdentityPair, self).__init__(moltype, *args, **kwargs)
-        self.func = _hamming
+        self.func = hamming
 
     def get_pairwise_distances(self, include_duplicates=True):
         """returns a matrix of pairwise distances.
@@ -584,7 +821,7 @@ class JC69Pair(_NucleicSeqPair):
     def __init__(self, moltype="dna", *args, **kwargs):
         """states: the valid sequence states"""
         super(JC69Pair, self).__init__(moltype, *args, **kwargs)
-        self.func = _jc69_from_matrix
+        self.func = jc69_from_matrix
 
 
 class TN93Pair(_NucleicSeqPair):
@@ -593,7 +830,6 @@ class TN93Pair(_NucleicSeqPair):
     def __init__(self, moltype="dna", *args, **kwargs):
         """states: the valid sequence states"""
         super(TN93Pair, self).__init__(moltype, *args, **kwargs)
-        self._freqs = zeros(self._dim, float64)
         self.pur_indices = get_purine_indices(self.moltype)
         self.pyr_indices = get_pyrimidine_indices(self.moltype)
 
@@ -610,14 +846,17 @@ class TN93Pair(_NucleicSeqPair):
         self.pur_coords = [i * 4 + j for i, j in self.pur_coords]
         self.tv_coords = [i * 4 + j for i, j in self.tv_coords]
 
-        self.func = _tn93_from_matrix
+        # class of each element of the flattened matrix, diagonal is DIAG
+        flat_class = zeros(self._dim ** 2, numpy.int8)
+        flat_class[self.pur_coords] = PUR_TS
+        flat_class[self.pyr_coords] = PYR_TS
+        flat_class[self.tv_coords] = TV
+
+        self.func = tn93_from_matrix
         self._func_args = [
-            self._freqs,
-            self.pur_indices,
-            self.pyr_indices,
-            self.pur_coords,
-            self.pyr_coords,
-            self.tv_coords,
+            array(self.pur_indices, int32),
+            array(self.pyr_indices, int32),
+            flat_class,
         ]
 
 
@@ -632,9 +871,14 @@ class LogDetPair(_PairwiseDistance):
         - use_tk_adjustment: use the correction of Tamura and Kumar 2002
         """
         super(LogDetPair, self).__init__(moltype, *args, **kwargs)
-        self.func = _logdet
+        self.func = logdet
         self._func_args = [use_tk_adjustment]
 
+    @property
+    def _estimates_variance(self):
+        # the variance is not estimated with the Tamura and Kumar correction
+        return not self._func_args[0]
+
     def run(self, use_tk_adjustment=None, *args, **kwargs):
         if use_tk_adjustment is not None:
             self._func_args = [use_tk_adjustment]
@@ -649,7 +893,7 @@ class ParalinearPair(_PairwiseDistance):
 
     def __init__(self, moltype="dna", *args, **kwargs):
         super(ParalinearPair, self).__init__(moltype, *args, **kwargs)
-        self.func = _paralinear
+        self.func = paralinear
 
 
 _calculators = {
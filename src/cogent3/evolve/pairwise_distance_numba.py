@@ -1,4 +1,6 @@
-from numba import njit
+import numpy
+
+from numba import njit, prange
 
 
 __author__ = "Gavin Huttley, Yicheng Zhu and Ben Kaehler"
@@ -12,16 +14,423 @@ __status__ = "Alpha"
 
 # turn off code coverage as njit-ted code not accessible to coverage
 
+_NUM_COUNTERS = 4
+
+
+@njit(cache=True, boundscheck=False)
+def seq_to_indices(ords, char_to_index, out):  # pragma: no cover
+    """writes the index of each character ordinal in ords to out
+
+    char_to_index must have an entry for every value of ords, which
+    get_moltype_index_array guarantees for uint8 ords."""
+    for k in range(ords.shape[0]):
+        out[k] = char_to_index[ords[k]]
+
+
+@njit(cache=True, boundscheck=False)
+def _count_pairs(matrix, seq1, seq2, dim):  # pragma: no cover
+    # Counting is done into _NUM_COUNTERS interleaved integer histograms of
+    # flat codes so consecutive increments don't wait on each other. Pairs
+    # with an invalid member are sent to an extra (discarded) slot; (a | b) is
+    # negative if either is negative, so there is no data-dependent branch.
+    size = dim * dim
+    counts = numpy.zeros((_NUM_COUNTERS, size + 1), dtype=numpy.int64)
+    num_pos = seq1.shape[0]
+    end = num_pos - num_pos % _NUM_COUNTERS
+    for k in range(0, end, _NUM_COUNTERS):
+        for u in range(_NUM_COUNTERS):
+            a = seq1[k + u]
+            b = seq2[k + u]
+            code = a * dim + b if (a | b) >= 0 else size
+            counts[u, code] += 1
+
+    for k in range(end, num_pos):
+        a = seq1[k]
+        b = seq2[k]
+        code = a * dim + b if (a | b) >= 0 else size
+        counts[0, code] += 1
+
+    for i in range(dim):
+        for j in range(dim):
+            total = 0
+            for u in range(_NUM_COUNTERS):
+                total += counts[u, i * dim + j]
+            matrix[i, j] += total
+
+
 # fills in a diversity matrix from sequences of integers
-@njit(cache=True)
+@njit(cache=True, boundscheck=False)
 def fill_diversity_matrix(matrix, seq1, seq2):  # pragma: no cover
     """fills the diversity matrix for valid positions.
 
     Assumes the provided sequences have been converted to indices with
     invalid characters being negative numbers (use get_moltype_index_array
-    plus seq_to_indices)."""
+    plus seq_to_indices). Counts are added to the existing values in
+    matrix."""
+    if matrix.shape[1] == 4:
+        # a constant dim for nucleotides lets the compiler specialise the loops
+        _count_pairs(matrix, seq1, seq2, 4)
+    else:
+        _count_pairs(matrix, seq1, seq2, matrix.shape[1])
+
+
+@njit(cache=True, parallel=True, boundscheck=False)
+def fill_diversity_matrices(matrices, indexed_seqs, pairs):  # pragma: no cover
+    """fills the diversity matrix for each pair of sequences in parallel
+
+    Parameters
+    ----------
+    matrices
+        3D array, matrices[k] is filled for the sequences in pairs[k], it does
+        not need to be initialised
+    indexed_seqs
+        2D array of sequences converted to indices
+    pairs
+        2D array of row indices into indexed_seqs
+    """
+    for k in prange(pairs.shape[0]):
+        matrices[k][:] = 0.0
+        fill_diversity_matrix(
+            matrices[k], indexed_seqs[pairs[k, 0]], indexed_seqs[pairs[k, 1]]
+        )
+
+
+@njit(cache=True, boundscheck=False)
+def fill_diversity_matrices_serial(matrices, indexed_seqs, pairs):  # pragma: no cover
+    """fills the diversity matrix for each pair of sequences
+
+    As fill_diversity_matrices, but does not use numba's thread pool so is
+    safe to call from any thread."""
+    for k in range(pairs.shape[0]):
+        matrices[k][:] = 0.0
+        fill_diversity_matrix(
+            matrices[k], indexed_seqs[pairs[k, 0]], indexed_seqs[pairs[k, 1]]
+        )
+
+
+@njit(cache=True, boundscheck=False)
+def has_offdiag(seq1, seq2):  # pragma: no cover
+    """returns True if the sequences differ at a position where both are valid
 
-    for i in range(len(seq1)):
-        if seq1[i] < 0 or seq2[i] < 0:
+    Returns on the first difference, so is cheaper than filling the diversity
+    matrix."""
+    for k in range(seq1.shape[0]):
+        a = seq1[k]
+        b = seq2[k]
+        if a >= 0 and b >= 0 and a != b:
+            return True
+    return False
+
+
+@njit(cache=True, boundscheck=False)
+def get_duplicates(indexed_seqs):  # pragma: no cover
+    """returns the index of the sequence each sequence duplicates, -1 if none
+
+    Sequence j is a duplicate of an earlier, non-duplicate, sequence i if
+    they do not differ at any position where both are valid."""
+    num_seqs = indexed_seqs.shape[0]
+    parent = numpy.full(num_seqs, -1, numpy.int64)
+    for i in range(num_seqs - 1):
+        if parent[i] >= 0:
             continue
-        matrix[seq1[i], seq2[i]] += 1.0
+        for j in range(i + 1, num_seqs):
+            if parent[j] >= 0:
+                continue
+            if not has_offdiag(indexed_seqs[i], indexed_seqs[j]):
+                parent[j] = i
+    return parent
+
+
+# the distance kernels return a flag indicating whether the statistics could
+# be computed followed by the total, proportion of differences, distance and
+# variance. When the flag is False, the statistics are nan.
+
+
+@njit(cache=True, error_model="numpy")
+def hamming(matrix):  # pragma: no cover
+    """computes the edit distance from a diversity matrix
+
+    Returns
+    -------
+    whether the statistics are valid, total of the matrix, the proportion of
+    changes, hamming distance, variance (the variance calculation is not yet
+    implemented, so it is nan)
+    """
+    total = 0.0
+    same = 0.0
+    for i in range(matrix.shape[0]):
+        for j in range(matrix.shape[1]):
+            total += matrix[i, j]
+        same += matrix[i, i]
+
+    if total == 0:
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    dist = total - same
+    return True, total, dist / total, dist, numpy.nan
+
+
+@njit(cache=True, error_model="numpy")
+def jc69_from_matrix(matrix):  # pragma: no cover
+    """computes JC69 stats from a diversity matrix"""
+    total = 0.0
+    same = 0.0
+    for i in range(matrix.shape[0]):
+        for j in range(matrix.shape[1]):
+            total += matrix[i, j]
+        same += matrix[i, i]
+
+    if total == 0:
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    p = (total - same) / total
+    if p >= 0.75:  # cannot take log
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    factor = 1 - (4 / 3) * p
+    dist = -3.0 * numpy.log(factor) / 4
+    var = p * (1 - p) / (factor * factor * total)
+    return True, total, p, dist, var
+
+
+# classes of the elements of a flattened TN93 diversity matrix
+DIAG, PUR_TS, PYR_TS, TV = 0, 1, 2, 3
+
+
+@njit(cache=True, error_model="numpy")
+def tn93_from_matrix(matrix, pur_indices, pyr_indices, flat_class):  # pragma: no cover
+    """computes TN93 stats from a diversity matrix
+
+    flat_class assigns each element of the flattened matrix to one of
+    DIAG, PUR_TS, PYR_TS or TV."""
+    dim = matrix.shape[1]
+    total = 0.0
+    pur_ts_diffs = 0.0
+    pyr_ts_diffs = 0.0
+    tv_diffs = 0.0
+    freqs = numpy.zeros(dim)
+    for i in range(matrix.shape[0]):
+        for j in range(dim):
+            val = matrix[i, j]
+            total += val
+            freqs[i] += val
+            freqs[j] += val
+            kind = flat_class[i * dim + j]
+            if kind == PUR_TS:
+                pur_ts_diffs += val
+            elif kind == PYR_TS:
+                pyr_ts_diffs += val
+            elif kind == TV:
+                tv_diffs += val
+
+    if total == 0:
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    for i in range(dim):
+        freqs[i] /= 2 * total
+
+    p = (pur_ts_diffs + pyr_ts_diffs + tv_diffs) / total
+    pur_ts_diffs /= total
+    pyr_ts_diffs /= total
+    tv_diffs /= total
+
+    freq_purs = 0.0
+    prod_purs = 1.0
+    for i in pur_indices:
+        freq_purs += freqs[i]
+        prod_purs *= freqs[i]
+    freq_pyrs = 0.0
+    prod_pyrs = 1.0
+    for i in pyr_indices:
+        freq_pyrs += freqs[i]
+        prod_pyrs *= freqs[i]
+
+    coeff1 = 2 * prod_purs / freq_purs
+    coeff2 = 2 * prod_pyrs / freq_pyrs
+    coeff3 = 2 * (
+        freq_purs * freq_pyrs
+        - (prod_purs * freq_pyrs / freq_purs)
+        - (prod_pyrs * freq_purs / freq_pyrs)
+    )
+
+    term1 = 1 - pur_ts_diffs / coeff1 - tv_diffs / (2 * freq_purs)
+    term2 = 1 - pyr_ts_diffs / coeff2 - tv_diffs / (2 * freq_pyrs)
+    term3 = 1 - tv_diffs / (2 * freq_purs * freq_pyrs)
+
+    if term1 <= 0 or term2 <= 0 or term3 <= 0:  # log will fail
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    dist = (
+        -coeff1 * numpy.log(term1)
+        - coeff2 * numpy.log(term2)
+        - coeff3 * numpy.log(term3)
+    )
+    v1 = 1 / term1
+    v2 = 1 / term2
+    v3 = 1 / term3
+    v4 = (
+        (coeff1 * v1 / (2 * freq_purs))
+        + (coeff2 * v2 / (2 * freq_pyrs))
+        + (coeff3 * v3 / (2 * freq_purs * freq_pyrs))
+    )
+    var = (
+        v1 ** 2 * pur_ts_diffs
+        + v2 ** 2 * pyr_ts_diffs
+        + v4 ** 2 * tv_diffs
+        - (v1 * pur_ts_diffs + v2 * pyr_ts_diffs + v4 * tv_diffs) ** 2
+    )
+    var /= total
+
+    return True, total, p, dist, var
+
+
+@njit(cache=True)
+def _cofactors4(m):  # pragma: no cover
+    """returns the determinant and the 2x2 minors of the top (s) and
+    bottom (c) row pairs of a 4x4 matrix"""
+    s = (
+        m[0, 0] * m[1, 1] - m[1, 0] * m[0, 1],
+        m[0, 0] * m[1, 2] - m[1, 0] * m[0, 2],
+        m[0, 0] * m[1, 3] - m[1, 0] * m[0, 3],
+        m[0, 1] * m[1, 2] - m[1, 1] * m[0, 2],
+        m[0, 1] * m[1, 3] - m[1, 1] * m[0, 3],
+        m[0, 2] * m[1, 3] - m[1, 2] * m[0, 3],
+    )
+    c = (
+        m[2, 0] * m[3, 1] - m[3, 0] * m[2, 1],
+        m[2, 0] * m[3, 2] - m[3, 0] * m[2, 2],
+        m[2, 0] * m[3, 3] - m[3, 0] * m[2, 3],
+        m[2, 1] * m[3, 2] - m[3, 1] * m[2, 2],
+        m[2, 1] * m[3, 3] - m[3, 1] * m[2, 3],
+        m[2, 2] * m[3, 3] - m[3, 2] * m[2, 3],
+    )
+    det = (
+        s[0] * c[5]
+        - s[1] * c[4]
+        + s[2] * c[3]
+        + s[3] * c[2]
+        - s[4] * c[1]
+        + s[5] * c[0]
+    )
+    return det, s, c
+
+
+@njit(cache=True)
+def _det4(matrix):  # pragma: no cover
+    """returns the determinant of a 4x4 matrix"""
+    return _cofactors4(matrix)[0]
+
+
+@njit(cache=True, error_model="numpy")
+def _inv4(matrix):  # pragma: no cover
+    """returns the inverse of a 4x4 matrix"""
+    det, s, c = _cofactors4(matrix)
+    m = matrix
+    result = numpy.empty((4, 4))
+    result[0, 0] = m[1, 1] * c[5] - m[1, 2] * c[4] + m[1, 3] * c[3]
+    result[0, 1] = -m[0, 1] * c[5] + m[0, 2] * c[4] - m[0, 3] * c[3]
+    result[0, 2] = m[3, 1] * s[5] - m[3, 2] * s[4] + m[3, 3] * s[3]
+    result[0, 3] = -m[2, 1] * s[5] + m[2, 2] * s[4] - m[2, 3] * s[3]
+    result[1, 0] = -m[1, 0] * c[5] + m[1, 2] * c[2] - m[1, 3] * c[1]
+    result[1, 1] = m[0, 0] * c[5] - m[0, 2] * c[2] + m[0, 3] * c[1]
+    result[1, 2] = -m[3, 0] * s[5] + m[3, 2] * s[2] - m[3, 3] * s[1]
+    result[1, 3] = m[2, 0] * s[5] - m[2, 2] * s[2] + m[2, 3] * s[1]
+    result[2, 0] = m[1, 0] * c[4] - m[1, 1] * c[2] + m[1, 3] * c[0]
+    result[2, 1] = -m[0, 0] * c[4] + m[0, 1] * c[2] - m[0, 3] * c[0]
+    result[2, 2] = m[3, 0] * s[4] - m[3, 1] * s[2] + m[3, 3] * s[0]
+    result[2, 3] = -m[2, 0] * s[4] + m[2, 1] * s[2] - m[2, 3] * s[0]
+    result[3, 0] = -m[1, 0] * c[3] + m[1, 1] * c[1] - m[1, 2] * c[0]
+    result[3, 1] = m[0, 0] * c[3] - m[0, 1] * c[1] + m[0, 2] * c[0]
+    result[3, 2] = -m[3, 0] * s[3] + m[3, 1] * s[1] - m[3, 2] * s[0]
+    result[3, 3] = m[2, 0] * s[3] - m[2, 1] * s[1] + m[2, 2] * s[0]
+    result /= det
+    return result
+
+
+@njit(cache=True, error_model="numpy")
+def _logdetcommon(matrix):  # pragma: no cover
+    """returns the terms shared by the LogDet and paralinear distances
+
+    The first element is False if the distance cannot be computed."""
+    dim = matrix.shape[0]
+    total = 0.0
+    same = 0.0
+    for i in range(dim):
+        for j in range(dim):
+            total += matrix[i, j]
+        same += matrix[i, i]
+
+    p = (total - same) / total
+    frequency = matrix.copy()
+    freqs_0 = numpy.zeros(dim)
+    freqs_1 = numpy.zeros(dim)
+    if total == 0 or total == same:  # no data or seqs indentical
+        return False, total, p, frequency, 0.0, freqs_0, freqs_1, 0.0
+
+    # we replace the missing diagonal states with a frequency of 0.5,
+    # then normalise
+    norm = 0.0
+    for i in range(dim):
+        if frequency[i, i] == 0:
+            frequency[i, i] = 0.5
+        for j in range(dim):
+            norm += frequency[i, j]
+    frequency /= norm
+
+    # closed form solutions avoid the LAPACK overhead for nucleotides
+    det = _det4(frequency) if dim == 4 else numpy.linalg.det(frequency)
+    if det <= 0:  # if the result is nan
+        return False, total, p, frequency, det, freqs_0, freqs_1, 0.0
+
+    # the inverse matrix of frequency, every element is squared
+    inverse = _inv4(frequency) if dim == 4 else numpy.linalg.inv(frequency)
+    m_matrix = inverse ** 2
+    var_term = 0.0
+    for i in range(dim):
+        for j in range(dim):
+            freqs_0[j] += frequency[i, j]
+            freqs_1[i] += frequency[i, j]
+            var_term += m_matrix[i, j] * frequency[j, i]
+
+    return True, total, p, frequency, det, freqs_0, freqs_1, var_term
+
+
+@njit(cache=True, error_model="numpy")
+def paralinear(matrix):  # pragma: no cover
+    """the paralinear distance from a diversity matrix"""
+    valid, total, p, frequency, det, freqs_0, freqs_1, var_term = _logdetcommon(matrix)
+    if not valid:
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    r = matrix.shape[0]
+    prod = freqs_0 * freqs_1
+    d_xy = -numpy.log(det / numpy.sqrt(prod.prod())) / r
+    var = (var_term - (1 / numpy.sqrt(prod)).sum()) / (r ** 2 * total)
+
+    return True, total, p, d_xy, var
+
+
+@njit(cache=True, error_model="numpy")
+def logdet(matrix, use_tk_adjustment=True):  # pragma: no cover
+    """returns the LogDet from a diversity matrix
+
+    Parameters
+    ----------
+    use_tk_adjustment
+        when True, unequal state frequencies are allowed
+
+    """
+    valid, total, p, frequency, det, freqs_0, freqs_1, var_term = _logdetcommon(matrix)
+    if not valid:
+        return False, numpy.nan, numpy.nan, numpy.nan, numpy.nan
+
+    r = matrix.shape[0]
+    if use_tk_adjustment:
+        coeff = (((freqs_0 + freqs_1) ** 2).sum() / 4 - 1) / (r - 1)
+        d_xy = coeff * numpy.log(det / numpy.sqrt((freqs_0 * freqs_1).prod()))
+        var = numpy.nan
+    else:
+        d_xy = -numpy.log(det) / r - numpy.log(r)
+        var = (var_term / r ** 2 - 1) / total
+
+    return True, total, p, d_xy, var
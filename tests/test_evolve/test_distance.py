@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 import os
+import threading
 import warnings
 
-from unittest import TestCase, main
+from unittest import TestCase, main, skipIf
 
 import numpy
 
@@ -12,6 +13,7 @@ from cogent3 import (
     DNA,
     PROTEIN,
     RNA,
+    get_moltype,
     load_aligned_seqs,
     make_aligned_seqs,
     make_unaligned_seqs,
@@ -25,20 +27,50 @@ from cogent3.evolve.fast_distance import (
     ParalinearPair,
     PercentIdentityPair,
     TN93Pair,
+    _all_diversity_matrices,
     _calculators,
     _fill_diversity_matrix,
     _hamming,
     _jc69_from_matrix,
+    _logdet,
+    _paralinear,
+    _tn93_from_matrix,
     available_distances,
     get_distance_calculator,
     get_moltype_index_array,
     seq_to_indices,
 )
 from cogent3.evolve.models import F81, HKY85, JC69
+from cogent3.evolve.pairwise_distance_numba import (
+    _det4,
+    _inv4,
+    fill_diversity_matrices,
+    fill_diversity_matrices_serial,
+)
 from cogent3.evolve.pairwise_distance_numba import (
     fill_diversity_matrix as numba_fill_diversity_matrix,
 )
+from cogent3.evolve.pairwise_distance_numba import get_duplicates
+from cogent3.evolve.pairwise_distance_numba import hamming as numba_hamming
+from cogent3.evolve.pairwise_distance_numba import (
+    jc69_from_matrix as numba_jc69_from_matrix,
+)
+from cogent3.evolve.pairwise_distance_numba import logdet as numba_logdet
+from cogent3.evolve.pairwise_distance_numba import (
+    paralinear as numba_paralinear,
+)
+from cogent3.evolve.pairwise_distance_numba import (
+    tn93_from_matrix as numba_tn93_from_matrix,
+)
+
 
+try:
+    import cupy
+
+    if not cupy.cuda.is_available():
+        cupy = None
+except ImportError:
+    cupy = None
 
 warnings.filterwarnings("ignore", "Not using MPI as mpi4py not found")
 
@@ -81,6 +113,42 @@ class TestPair(TestCase):
         seq = "UCAGRNY?-"
         indices = seq_to_indices(seq, self.rna_char_indices)
         assert_equal(indices, expected)
+        # bytes are also accepted
+        indices = seq_to_indices(seq.encode("ascii"), self.rna_char_indices)
+        assert_equal(indices, expected)
+        # any byte value is looked up, those not in the moltype are invalid
+        self.assertEqual(len(self.dna_char_indices), 256)
+        indices = seq_to_indices(bytes([0, 65, 255]), self.dna_char_indices)
+        assert_equal(indices, [-9, 2, -9])
+
+    def test_index_dtype(self):
+        """indices use the smallest integer type for the moltype"""
+        self.assertEqual(self.dna_char_indices.dtype, numpy.int8)
+        self.assertEqual(
+            get_moltype_index_array(get_moltype("bytes")).dtype, numpy.int16
+        )
+        calc = JC69Pair(DNA, alignment=self.alignment)
+        self.assertEqual(calc.indexed_seqs.dtype, numpy.int8)
+        self.assertTrue(calc.indexed_seqs.flags["C_CONTIGUOUS"])
+
+    def test_index_invalid(self):
+        """the dtype holds the invalid value, which must be negative"""
+        indices = get_moltype_index_array(DNA, invalid=-200)
+        self.assertEqual(indices.dtype, numpy.int16)
+        assert_equal(seq_to_indices("TN-", indices), [0, -200, -200])
+        for invalid in (0, 3, -1.5, None):
+            with self.assertRaises(ValueError):
+                get_moltype_index_array(DNA, invalid=invalid)
+
+        aln = make_aligned_seqs(
+            data={"a": "ACGT--ACGT", "b": "ACGA--ACGT", "c": "ACGTNNAAGT"},
+            moltype=DNA,
+        )
+        expect = JC69Pair(DNA, alignment=aln)
+        expect.run(show_progress=False)
+        got = JC69Pair(DNA, invalid=-200, alignment=aln)
+        got.run(show_progress=False)
+        assert_allclose(got.dists.array, expect.dists.array)
 
     def test_fill_diversity_matrix_all(self):
         """make correct diversity matrix when all chars valid"""
@@ -132,6 +200,186 @@ class TestPair(TestCase):
         numba_fill_diversity_matrix(matrix2, s1, s2)
         assert_allclose(matrix1, matrix2)
 
+    def test_fill_diversity_matrices(self):
+        """diversity matrices for multiple pairs match those for single pairs"""
+        seqs = numpy.array(
+            [
+                seq_to_indices(s, self.dna_char_indices)
+                for s in ("RACGTACGTACN", "AGTGTACGTACA", "ACGTTTCGTACA")
+            ]
+        )
+        pairs = numpy.array([(0, 1), (0, 2), (1, 2)])
+        # the kernel initialises the matrices
+        for fill in (fill_diversity_matrices, fill_diversity_matrices_serial):
+            matrices = numpy.full((3, 4, 4), 99, float)
+            fill(matrices, seqs, pairs)
+            for (i, j), got in zip(pairs, matrices):
+                expect = numpy.zeros((4, 4), float)
+                _fill_diversity_matrix(expect, seqs[i], seqs[j])
+                assert_equal(got, expect)
+
+    def test_fill_diversity_matrix_lengths(self):
+        """diversity matrix correct for any length and scattered invalid"""
+        rng = numpy.random.default_rng(13)
+        for length in (0, 1, 3, 4, 5, 7, 101):
+            seqs = rng.integers(-9, 4, size=(2, length)).astype(numpy.int8)
+            seqs[seqs < -1] = rng.integers(0, 4, size=(seqs < -1).sum())
+            got = numpy.full((4, 4), 99, float)
+            numba_fill_diversity_matrix(got, seqs[0], seqs[1])
+            # both add to the existing counts
+            expect = numpy.full((4, 4), 99, float)
+            _fill_diversity_matrix(expect, seqs[0], seqs[1])
+            assert_equal(got, expect)
+
+    def test_get_duplicates(self):
+        """sequences identical at shared valid positions are duplicates"""
+        seqs = numpy.array(
+            [
+                seq_to_indices(s, self.dna_char_indices)
+                for s in ("ACGTACGTAC", "NCGTACGTAN", "GTGTACGTAC", "ACGTACGTAC")
+            ]
+        )
+        assert_equal(get_duplicates(seqs), [-1, 0, -1, 0])
+        # a duplicate is not used as the reference for later seqs
+        seqs = numpy.array(
+            [
+                seq_to_indices(s, self.dna_char_indices)
+                for s in ("ACGTAC", "ACNNAC", "NNCAAC")
+            ]
+        )
+        assert_equal(get_duplicates(seqs), [-1, 0, -1])
+
+    def test_all_diversity_matrices(self):
+        """diversity matrices from one-hot encoding match those for single pairs"""
+        seqs = numpy.array(
+            [
+                seq_to_indices(s, self.dna_char_indices)
+                for s in ("RACGTACGTACN", "AGTGTACGTACA", "ACGTTTCGTACA")
+            ]
+        )
+        got = _all_diversity_matrices(seqs, seqs, 4)
+        self.assertEqual(got.shape, (3, 3, 4, 4))
+        for i in range(3):
+            for j in range(3):
+                expect = numpy.zeros((4, 4), float)
+                _fill_diversity_matrix(expect, seqs[i], seqs[j])
+                assert_equal(got[i, j], expect)
+        # between a subset of the sequences and all of them
+        got = _all_diversity_matrices(seqs[1:], seqs, 4)
+        self.assertEqual(got.shape, (2, 3, 4, 4))
+        for i in range(2):
+            for j in range(3):
+                expect = numpy.zeros((4, 4), float)
+                _fill_diversity_matrix(expect, seqs[i + 1], seqs[j])
+                assert_equal(got[i, j], expect)
+
+    def test_iter_diversity_matrices(self):
+        """diversity matrices are correct when the pairs span several buffers"""
+        rng = numpy.random.default_rng(11)
+        data = {
+            f"s{i}": "".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY-"), 30))
+            for i in range(20)
+        }
+        calc = HammingPair(PROTEIN, alignment=make_aligned_seqs(data, moltype=PROTEIN))
+        pairs = numpy.array(numpy.triu_indices(20, k=1)).T
+        # the matrices are views of a reused buffer, so are checked as yielded
+        num = 0
+        for i, j, matrix in calc._iter_diversity_matrices(pairs):
+            expect = numpy.zeros((calc._dim, calc._dim), float)
+            _fill_diversity_matrix(expect, calc.indexed_seqs[i], calc.indexed_seqs[j])
+            assert_equal(matrix, expect)
+            num += 1
+        self.assertEqual(num, len(pairs))
+
+    def test_diversity_matrices_product(self):
+        """diversity matrices from chunked matrix products match the kernel"""
+        rng = numpy.random.default_rng(7)
+        data = {f"s{i}": "".join(rng.choice(list("ACGTN-"), 53)) for i in range(9)}
+        aln = make_aligned_seqs(data=data, moltype=DNA)
+        calc = TN93Pair(DNA, alignment=aln)
+        pairs = numpy.array(numpy.triu_indices(9, k=1)).T
+        expect = [(i, j, m.copy()) for i, j, m in calc._iter_diversity_matrices(pairs)]
+        # small bounds split both the sequences and positions into chunks
+        for max_elements in (1, 100, 2 ** 24):
+            got = list(
+                calc._iter_diversity_matrices_product(
+                    pairs, numpy, max_elements=max_elements
+                )
+            )
+            self.assertEqual(len(got), len(expect))
+            for (i, j, e), (i2, j2, g) in zip(expect, got):
+                self.assertEqual((i, j), (i2, j2))
+                assert_equal(g, e)
+
+        # no pairs when there are fewer than two unique sequences
+        no_pairs = numpy.zeros((0, 2), int)
+        self.assertEqual(
+            list(calc._iter_diversity_matrices_product(no_pairs, numpy)), []
+        )
+
+    @skipIf(cupy is None, "cupy not installed or no GPU available")
+    def test_gpu(self):
+        """distances computed on the GPU match those from the CPU"""
+        aln = load_aligned_seqs("data/brca1_5.paml", moltype=DNA)
+        expect = TN93Pair(DNA, alignment=aln)
+        expect.run(show_progress=False)
+        got = TN93Pair(DNA, alignment=aln, gpu=True)
+        got.run(show_progress=False)
+        assert_allclose(got.dists.array, expect.dists.array)
+
+    @skipIf(cupy is not None, "cupy is available")
+    def test_gpu_unavailable(self):
+        """requesting the GPU without cupy raises an exception"""
+        calc = TN93Pair(DNA, alignment=self.alignment, gpu=True)
+        with self.assertRaises((ImportError, RuntimeError)):
+            calc.run(show_progress=False)
+
+    def test_python_vs_numba_distances(self):
+        """python & numba distance functions give same answer"""
+        s1 = seq_to_indices("TAATTCATTGGGACGTCGAATCCGGCAGTC", self.dna_char_indices)
+        s2 = seq_to_indices("AAAAAAAACCCCCCCCTTTTTTTTGGGGGG", self.dna_char_indices)
+        matrix = numpy.zeros((4, 4), float)
+        _fill_diversity_matrix(matrix, s1, s2)
+        calc = TN93Pair(DNA)
+        tn93_args = (
+            None,
+            calc.pur_indices,
+            calc.pyr_indices,
+            calc.pur_coords,
+            calc.pyr_coords,
+            calc.tv_coords,
+        )
+        for py_func, py_args, nb_func, nb_args in [
+            (_hamming, (), numba_hamming, ()),
+            (_jc69_from_matrix, (), numba_jc69_from_matrix, ()),
+            (_paralinear, (), numba_paralinear, ()),
+            (_logdet, (True,), numba_logdet, (True,)),
+            (_logdet, (False,), numba_logdet, (False,)),
+            (_tn93_from_matrix, tn93_args, numba_tn93_from_matrix, calc._func_args),
+        ]:
+            expect = py_func(matrix, *py_args)
+            valid, *got = nb_func(matrix, *nb_args)
+            # the python functions indicate an invalid result with None
+            self.assertEqual(valid, expect[2] is not None)
+            expect = [numpy.nan if v is None else v for v in expect]
+            assert_allclose(got, expect)
+        # an invalid result is flagged
+        valid, *got = numba_jc69_from_matrix(numpy.zeros((4, 4), float))
+        self.assertFalse(valid)
+
+    def test_closed_form_4x4(self):
+        """closed form 4x4 determinant and inverse match numpy"""
+        matrix = numpy.array(
+            [
+                [0.2, 0.01, 0.03, 0.0],
+                [0.02, 0.3, 0.0, 0.01],
+                [0.0, 0.01, 0.2, 0.02],
+                [0.01, 0.0, 0.04, 0.15],
+            ]
+        )
+        assert_allclose(_det4(matrix), numpy.linalg.det(matrix))
+        assert_allclose(_inv4(matrix), numpy.linalg.inv(matrix))
+
     def test_hamming_from_matrix(self):
         """compute hamming from diversity matrix"""
         s1 = seq_to_indices("ACGTACGTAC", self.dna_char_indices)
@@ -495,6 +743,63 @@ class TestPair(TestCase):
         self.assertEqual(logdet_calc.dists[1, 1], paralinear_calc.dists[1, 1])
         self.assertEqual(paralinear_calc.variances[1, 1], logdet_calc.variances[1, 1])
 
+    def test_nan_stats(self):
+        """computed nan statistics are kept, only invalid ones are None"""
+        # without G the TN93 purine terms are nan, but the result is valid
+        aln = make_aligned_seqs(
+            data={"a": "AAAACCCCTT", "b": "AAAACCCCTC"}, moltype=DNA
+        )
+        calc = TN93Pair(DNA, alignment=aln, invalid_raises=True)
+        calc.run(show_progress=False)
+        stats = calc._dists[("a", "b")]
+        self.assertEqual(stats.length, 10)
+        self.assertTrue(numpy.isnan(stats.dist))
+        self.assertTrue(numpy.isnan(stats.variance))
+        # an invalid result is None
+        calc = JC69Pair(
+            DNA, alignment=make_aligned_seqs(data={"a": "AC", "b": "CA"}, moltype=DNA)
+        )
+        calc.run(show_progress=False)
+        self.assertEqual(calc._dists[("a", "b")], (None, None, None, None))
+        # the variance is not estimated for hamming
+        calc = HammingPair(DNA, alignment=aln)
+        calc.run(show_progress=False)
+        self.assertIsNone(calc._dists[("a", "b")].variance)
+
+    def test_stats_stored_once(self):
+        """each pair of sequences has a single stats entry"""
+        aln = load_aligned_seqs("data/brca1_5.paml", moltype=DNA)
+        calc = TN93Pair(DNA, alignment=aln)
+        calc.run(show_progress=False)
+        self.assertEqual(len(calc._dists), 10)
+        dists = calc.get_pairwise_distances()
+        lengths = calc.lengths
+        for i, n1 in enumerate(aln.names):
+            self.assertEqual(lengths[n1, n1], 0)
+            for n2 in aln.names[i + 1 :]:
+                self.assertEqual(dists[n1, n2], dists[n2, n1])
+                self.assertEqual(lengths[n1, n2], lengths[n2, n1])
+
+    def test_parallel(self):
+        """filling matrices in parallel gives the same distances"""
+        aln = load_aligned_seqs("data/brca1_5.paml", moltype=DNA)
+        serial = TN93Pair(DNA, alignment=aln)
+        serial.run(show_progress=False)
+        parallel = TN93Pair(DNA, alignment=aln, parallel=True)
+        parallel.run(show_progress=False)
+        assert_allclose(parallel.dists.array, serial.dists.array)
+
+    def test_run_in_thread(self):
+        """distances can be computed from a thread other than the main one"""
+        aln = load_aligned_seqs("data/brca1_5.paml", moltype=DNA)
+        expect = TN93Pair(DNA, alignment=aln)
+        expect.run(show_progress=False)
+        calc = TN93Pair(DNA, alignment=aln)
+        thread = threading.Thread(target=calc.run, kwargs=dict(show_progress=False))
+        thread.start()
+        thread.join()
+        assert_allclose(calc.dists.array, expect.dists.array)
+
     def test_duplicated(self):
         """correctly identifies duplicates"""
 